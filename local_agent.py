@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import subprocess
 from rich.console import Console
 from rich.prompt import Prompt, Confirm
@@ -9,19 +10,165 @@ from rich.spinner import Spinner
 from rich.live import Live
 import sys
 import os
-import platform
-import shutil
 from typing import Optional
+from pathlib import Path
 import re
+import argparse
+import atexit
+import functools
+import time
+import signal
+import socket
+import tempfile
+import threading
+from urllib.parse import urlsplit
+from collections import deque
+
+# Ollama API endpoints, built once instead of on every request
+OLLAMA_URL = "http://localhost:11434"
+TAGS_URL = f"{OLLAMA_URL}/api/tags"
+CHAT_URL = f"{OLLAMA_URL}/api/chat"
+PULL_URL = f"{OLLAMA_URL}/api/pull"
+SHOW_URL = f"{OLLAMA_URL}/api/show"
+
+# (connect, read) timeouts in seconds applied to every request sent to Ollama
+REQUEST_TIMEOUT = (10, 300)
+
+# Models available on the Ollama server are cached between runs to skip the startup probe
+STATE_FILE = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "ollama-agent" / "state.json"
+MODEL_CACHE_TTL = 3600  # seconds
+# A model list fetched this recently also proves the server is up
+TAGS_FRESH_FOR = 30  # seconds
+# Every chat message is appended here so only the context window needs to stay in memory
+SESSION_FILE = STATE_FILE.with_name("session.jsonl")
+
+# Patterns used when extracting commands and converting them to fish syntax
+_CODE_BLOCK_RE = re.compile(r'```(?:bash|shell)[^\n]*\n(.*?)```', re.DOTALL)
+_INLINE_CODE_RE = re.compile(r'`([^`]+)`')
+# Prefixes that mark inline code spans and bare response lines as commands
+_CMD_PREFIXES = ('uname', 'ls', 'cd', 'sudo', 'apt', 'git', 'docker', 'python', 'pip')
+_SHELL_PREFIXES = ('$', '>', 'sudo', 'docker', 'git', 'npm', 'python', 'pip', 'apt', 'yum', 'brew')
+# A whole line starting with one of _SHELL_PREFIXES, without surrounding whitespace
+_COMMAND_LINE_RE = re.compile(
+    r'^[^\S\n]*((?:%s).*?)[^\S\n]*$' % '|'.join(map(re.escape, _SHELL_PREFIXES)),
+    re.MULTILINE
+)
+_NESTED_FOR_RE = re.compile(r'for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+(.*?)\s*done;\s*done')
+_RANGE_FOR_RE = re.compile(r'for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+(.*?)\s*done')
+_SEQ_FOR_RE = re.compile(r'for\s+(\w+)\s+in\s+\$\(seq\s+(\d+)\s+(\d+)\);\s*do\s+(.*?)\s*done')
+
+# Shells with dedicated handling, keyed by the executable name in $SHELL
+_SHELL_TYPES = {"fish": "fish", "zsh": "zsh", "bash": "bash"}
+
+@functools.lru_cache(maxsize=8)
+def _shell_type(shell_path):
+    """Shell type for a $SHELL value, cached since it rarely changes within a process"""
+    return _SHELL_TYPES.get(os.path.basename(shell_path), 'sh')  # default to sh
+
+@functools.lru_cache(maxsize=8)
+def _chat_body_prefix(model, stream, keep_alive):
+    """Encoded chat request up to its messages, cached per setting so only the messages are dumped per call"""
+    return orjson.dumps({
+        "model": model,
+        "stream": stream,
+        "keep_alive": keep_alive,  # Keep the model loaded between turns
+        "options": {
+            "num_gpu": 1,  # Use GPU if available
+            "num_thread": 4,  # Adjust based on your CPU
+            "model_size": "8b"  # Specify 8B parameter model
+        }
+    })[:-1] + b',"messages":'
+
+# Chat inputs handled locally instead of being sent to the model
+_EXIT_WORDS = frozenset(("exit", "EXIT", "Exit", "quit", "QUIT", "Quit"))
+_HELP_WORDS = frozenset(("help", "HELP", "Help", "?"))
+
+# Most command/feedback round-trips handled for one reply before control returns to the user
+MAX_COMMAND_ROUNDS = 10
+
+# Commands are killed after this many seconds, and only the head and tail of their output is kept
+COMMAND_TIMEOUT = 120
+OUTPUT_HEAD_SIZE = 64 * 1024
+OUTPUT_TAIL_SIZE = 16 * 1024
+# Longest chunk read from a command at once, so a single huge line can't bypass the limits above
+OUTPUT_READ_SIZE = 8192
+
+def _foreground_terminal():
+    """The terminal's file descriptor if this process is in its foreground, otherwise None"""
+    try:
+        fd = sys.stdin.fileno()
+        if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+            return fd
+    except (OSError, ValueError):  # e.g. stdin is closed or isn't a real file
+        pass
+    return None
+
+def _set_foreground(terminal, pgid):
+    """Make a process group the terminal's foreground"""
+    # A background group taking the terminal is sent SIGTTOU, which would stop the agent
+    blocked = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(terminal, pgid)
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+def _kill_process_group(process):
+    """Kill a command along with everything it started, and reap it"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # Everything in the group has already exited
+    process.wait()
+
+class BoundedOutput:
+    """Collects a command's output, keeping only its beginning and end"""
+
+    def __init__(self, head_size=OUTPUT_HEAD_SIZE, tail_size=OUTPUT_TAIL_SIZE):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = []
+        self.head_length = 0
+        self.tail = deque()
+        self.tail_length = 0
+        self.truncated = 0
+
+    def write(self, text):
+        if self.head_length < self.head_size:
+            self.head.append(text)
+            self.head_length += len(text)
+            return
+        self.tail.append(text)
+        self.tail_length += len(text)
+        while self.tail_length > self.tail_size:
+            dropped = self.tail.popleft()
+            self.tail_length -= len(dropped)
+            self.truncated += len(dropped)
+
+    def getvalue(self):
+        text = "".join(self.head)
+        if self.truncated:
+            text += f"\n... [{self.truncated} characters truncated] ...\n"
+        return text + "".join(self.tail)
 
 class LocalAgent:
-    def __init__(self):
+    def __init__(self, model="llama3:latest", keep_alive="30m", offline=False, stream=True):
         self.console = Console()
-        self.ollama_url = "http://localhost:11434"
-        # Using a smaller model for better performance
-        self.model = "llama3:latest"  # Updated to match available model
-        self.ensure_model()
-        self.conversation_history = []
+        self.model = model
+        # How long Ollama keeps the model loaded after a request, e.g. "30m" or -1 for forever
+        self.keep_alive = keep_alive
+        # Render replies token by token as they arrive, or wait for the complete reply
+        self.stream = stream
+        self.session = self.create_session()
+        self._session_log = None
+        atexit.register(self.close)
+        # Models listed by the last /api/tags response and when it was received
+        self._tags_cache = None
+        self._tags_checked_at = 0.0
+        if not offline:
+            self.ensure_model()
+        # Messages sent to Ollama as context; older ones only live in the session log
+        self._window_max = 20
+        self.conversation_history = deque(maxlen=self._window_max * 2)
         self.shell_type = self.detect_shell()
         self.system_prompt = f"""You are a helpful AI assistant that can execute commands on the user's system.
 When asked to show information or perform actions, you should:
@@ -38,36 +185,94 @@ ls ~/
 ```
 
 This will list all files and directories in your home folder."""
+        # Always sent first and never rebuilt, so Ollama can reuse its prefill for the system prompt
+        self._system_msg = {"role": "system", "content": self.system_prompt}
+
+    def create_session(self):
+        """Create a pooled HTTP session so calls to Ollama reuse keep-alive connections"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "Connection": "keep-alive",
+            "Accept-Encoding": "gzip, deflate",
+            "User-Agent": "ollama-agent/1.0"
+        })
+
+        # Apply a default timeout to every request made through the session
+        request = session.request
+
+        @functools.wraps(request)
+        def request_with_timeout(method, url, **kwargs):
+            kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+            return request(method, url, **kwargs)
+
+        session.request = request_with_timeout
+        return session
+
+    def close(self):
+        """Close the HTTP session and the session log"""
+        self.session.close()
+        if self._session_log:
+            self._session_log.close()
+            self._session_log = None
 
     def detect_shell(self):
         """Detect the current shell type"""
-        shell = os.environ.get('SHELL', '')
-        if 'fish' in shell:
-            return 'fish'
-        elif 'zsh' in shell:
-            return 'zsh'
-        elif 'bash' in shell:
-            return 'bash'
-        else:
-            return 'sh'  # default to sh
+        return _shell_type(os.environ.get('SHELL', ''))
 
     def ensure_model(self):
+        # Skip the network round-trip if a recent run already saw the model
+        if self.model in self.load_cached_models():
+            return
         try:
             # Check if model exists
-            response = requests.get(f"{self.ollama_url}/api/tags")
+            response = self.session.get(TAGS_URL)
             if response.status_code == 200:
-                models = response.json().get("models", [])
-                if not any(model["name"] == self.model for model in models):
+                models = [model["name"] for model in response.json().get("models", [])]
+                self._tags_cache = models
+                self._tags_checked_at = time.monotonic()
+                self.save_cached_models(models)
+                if self.model not in models:
                     self.console.print(f"[yellow]Model {self.model} not found. Pulling it now...[/yellow]")
                     self.pull_model()
         except Exception as e:
             self.console.print(f"[red]Error checking model status: {str(e)}[/red]")
 
+    def load_cached_models(self):
+        """Return the model names cached by a recent run, or an empty list if there are none"""
+        try:
+            with open(STATE_FILE, "rb") as f:
+                state = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return []
+        if state.get("ollama_url") != OLLAMA_URL or time.time() - state.get("timestamp", 0) > MODEL_CACHE_TTL:
+            return []
+        return state.get("models", [])
+
+    def save_cached_models(self, models):
+        """Cache the model names available on the Ollama server"""
+        state = {"ollama_url": OLLAMA_URL, "timestamp": time.time(), "models": models}
+        try:
+            STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            # Each run writes its own temp file and replaces atomically, so a concurrent run
+            # never reads a partial file or overwrites one being written
+            fd, tmp_file = tempfile.mkstemp(dir=STATE_FILE.parent, prefix="state.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(orjson.dumps(state))
+                os.replace(tmp_file, STATE_FILE)
+            except OSError:
+                os.unlink(tmp_file)
+                raise
+        except OSError:
+            pass  # The cache is only an optimization
+
     def pull_model(self):
         try:
             # Pull model with GPU configuration
-            response = requests.post(
-                f"{self.ollama_url}/api/pull",
+            response = self.session.post(
+                PULL_URL,
                 json={
                     "name": self.model,
                     "insecure": True  # Allow pulling from insecure sources if needed
@@ -88,7 +293,7 @@ This will list all files and directories in your home folder."""
     def check_gpu_usage(self):
         """Check if GPU is being used by Ollama"""
         try:
-            response = requests.get(f"{self.ollama_url}/api/show", params={"name": self.model})
+            response = self.session.get(SHOW_URL, params={"name": self.model})
             if response.status_code == 200:
                 model_info = response.json()
                 if model_info.get("gpu_layers", 0) > 0:
@@ -100,41 +305,57 @@ This will list all files and directories in your home folder."""
 
     def check_ollama_status(self):
         """Check if Ollama is running"""
+        # Ollama just answered ensure_model, so there is no need to probe it again
+        if self._tags_cache is not None and time.monotonic() - self._tags_checked_at < TAGS_FRESH_FOR:
+            return True
+        # Only reachability matters here, so a TCP connect is enough
+        url = urlsplit(OLLAMA_URL)
         try:
-            response = requests.get(f"{self.ollama_url}/api/tags")
-            return response.status_code == 200
-        except requests.exceptions.ConnectionError:
+            with socket.create_connection((url.hostname, url.port or 80), timeout=0.25):
+                return True
+        except OSError:
             return False
 
-    def start_chat(self):
+    def warm_up_model(self):
+        """Ask Ollama to load the model so the first reply doesn't wait for it"""
+        try:
+            # A chat request without messages only loads the model
+            self.session.post(
+                CHAT_URL,
+                data=orjson.dumps({"model": self.model, "messages": [], "keep_alive": self.keep_alive}),
+                headers={"Content-Type": "application/json"}
+            )
+        except requests.exceptions.RequestException:
+            pass  # The first real request will load the model instead
+
+    def start_chat(self, resume=False):
         if not self.check_ollama_status():
             self.console.print("[red]Error: Ollama is not running. Please start it using 'docker-compose up -d'[/red]")
             return
 
+        self.open_session_log(resume)
+        # Load the model in the background while the user types their first message
+        threading.Thread(target=self.warm_up_model, daemon=True).start()
+
         self.console.print(f"[green]Starting chat with Local Agent...[/green]")
         self.console.print(f"[yellow]Using {self.shell_type} shell[/yellow]")
         self.console.print(f"[yellow]Model: {self.model}[/yellow]")
         self.console.print("[yellow]Type 'exit' to end the chat, 'help' for commands[/yellow]")
 
-        # Initialize conversation with system prompt
-        self.conversation_history.append({"role": "system", "content": self.system_prompt})
-
         while True:
             try:
                 user_input = Prompt.ask("\n[blue]You[/blue]")
                 
-                if user_input.lower() == 'exit':
+                if user_input in _EXIT_WORDS:
                     break
-                elif user_input.lower() == 'help':
+                elif user_input in _HELP_WORDS:
                     self.show_help()
                     continue
 
-                # Get response from Ollama with spinner
-                with Live(Spinner("dots", text="Thinking..."), refresh_per_second=10, transient=True) as live:
-                    response = self.get_ollama_response(user_input)
-                    if response:
-                        self.console.print(f"\n[green]Assistant:[/green] {response}")
-                        self.conversation_history.append({"role": "assistant", "content": response})
+                # Get response from Ollama, rendered live as it streams in
+                response = self.get_ollama_response(user_input)
+                if response:
+                    self.add_message("assistant", response)
                 
                 # Process response and handle any commands
                 self.process_response(response)
@@ -148,122 +369,148 @@ This will list all files and directories in your home folder."""
 
     def process_response(self, response):
         """Process a response and handle any commands within it"""
-        if not response:
-            return
-            
-        # Check if the response contains a command to execute
-        if "```bash" in response or "```shell" in response:
-            command = self.extract_command(response)
-            if command:
-                output = self.execute_command(command)
-                if output:
-                    # Send command output back to Ollama for context with spinner
-                    with Live(Spinner("dots", text="Analyzing output..."), refresh_per_second=10, transient=True) as live:
-                        feedback_prompt = f"I executed the command '{command}' and got this output:\n{output}\nPlease analyze this output and let me know if you need any clarification or if there's anything important I should know."
-                        feedback_response = self.get_ollama_response(feedback_prompt)
-                        if feedback_response:
-                            self.console.print(f"\n[green]Assistant:[/green] {feedback_response}")
-                            self.conversation_history.append({"role": "assistant", "content": feedback_response})
-                            # Recursively process the feedback response for any follow-up commands
-                            self.process_response(feedback_response)
+        # Each feedback reply may ask for another command, so keep going until one doesn't
+        for _ in range(MAX_COMMAND_ROUNDS):
+            if not response:
+                return
+            # Only commands in ```bash or ```shell blocks are offered for execution
+            command = self.extract_command(response, fenced_only=True)
+            if command is None:
+                return
+            output = self.execute_command(command)
+            if not output:
+                return
+            # Send command output back as the next chat message; everything before it is
+            # already in Ollama's KV cache, so only the output itself needs prefilling
+            response = self.get_ollama_response(f"Command `{command}` output:\n{output}\nPlease analyze.")
+            if response:
+                self.add_message("assistant", response)
+        else:
+            # Only warn when the last reply asked for yet another command
+            if response and self.extract_command(response, fenced_only=True) is not None:
+                self.console.print(f"[yellow]Stopped after {MAX_COMMAND_ROUNDS} commands in a row[/yellow]")
+
+    def open_session_log(self, resume=False):
+        """Start logging the conversation, optionally restoring the previous session first"""
+        try:
+            SESSION_FILE.parent.mkdir(parents=True, exist_ok=True)
+            if resume and SESSION_FILE.exists():
+                # The history deque is bounded, so only the newest messages of the log are kept in memory
+                with open(SESSION_FILE, "rb") as f:
+                    for line in f:
+                        if line.strip():
+                            self.conversation_history.append(orjson.loads(line))
+                self.console.print(f"[yellow]Resumed previous session ({len(self.conversation_history)} recent messages)[/yellow]")
+            # Always append, so starting a chat without --resume never discards earlier ones
+            self._session_log = open(SESSION_FILE, "ab")
+        except (OSError, ValueError) as e:
+            self.console.print(f"[yellow]Session log unavailable: {str(e)}[/yellow]")
+
+    def add_message(self, role, content):
+        """Add a message to the conversation and append it to the session log"""
+        message = {"role": role, "content": content}
+        self.conversation_history.append(message)
+        if self._session_log:
+            self._session_log.write(orjson.dumps(message) + b"\n")
+            self._session_log.flush()
 
     def get_ollama_response(self, prompt):
         try:
-            # Include conversation history in the context
-            context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in self.conversation_history[-5:]])  # Last 5 messages for context
-            full_prompt = f"{context}\n\nUser: {prompt}\nAssistant:"
-            
-            response = requests.post(
-                f"{self.ollama_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": full_prompt,
-                    "stream": False,
-                    "options": {
-                        "num_gpu": 1,  # Use GPU if available
-                        "num_thread": 4,  # Adjust based on your CPU
-                        "model_size": "8b"  # Specify 8B parameter model
-                    }
-                }
+            # Grow the context window append-only and trim it in large steps, so consecutive
+            # requests share the same message prefix and Ollama can reuse its KV cache
+            while len(self.conversation_history) >= self._window_max:
+                for _ in range(self._window_max // 2):
+                    self.conversation_history.popleft()
+            user_message = {"role": "user", "content": prompt}
+            messages = [self._system_msg, *self.conversation_history, user_message]
+
+            response = self.session.post(
+                CHAT_URL,
+                data=_chat_body_prefix(self.model, self.stream, self.keep_alive) + orjson.dumps(messages) + b"}",
+                headers={"Content-Type": "application/json"},
+                stream=self.stream
             )
             if response.status_code == 200:
-                response_text = response.json().get("response", "")
-                self.conversation_history.append({"role": "user", "content": prompt})
+                if self.stream:
+                    response_text = self.render_stream(response)
+                else:
+                    response_text = orjson.loads(response.content)["message"]["content"]
+                    self.show_response(response_text)
+                self.add_message("user", prompt)
                 return response_text
             else:
                 self.console.print(f"[red]Error: Ollama returned status code {response.status_code}[/red]")
+                response.close()
                 return None
         except Exception as e:
             self.console.print(f"[red]Error getting response from Ollama: {str(e)}[/red]")
             return None
 
-    def extract_command(self, response: str) -> Optional[str]:
+    def render_stream(self, response):
+        """Render a streamed Ollama response as tokens arrive and return the full text"""
+        # Imported here since markdown parsing pulls in markdown-it, which only chat replies need
+        from rich.markdown import Markdown
+
+        tokens = []
+        last_render = 0.0
+        self.console.print("\n[green]Assistant:[/green]")
+        with Live(Spinner("dots", text="Thinking..."), console=self.console, refresh_per_second=10) as live:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                tokens.append(chunk.get("message", {}).get("content", ""))
+                # Re-parsing the markdown is the expensive part, so only do it at the refresh rate
+                now = time.monotonic()
+                if now - last_render >= 0.1:
+                    live.update(Markdown("".join(tokens)))
+                    last_render = now
+            # Read to the end even after the done chunk, so the connection goes back to the pool
+            text = "".join(tokens)
+            live.update(Markdown(text))
+        return text
+
+    def show_response(self, text):
+        """Render a complete assistant reply"""
+        from rich.markdown import Markdown
+
+        self.console.print("\n[green]Assistant:[/green]")
+        self.console.print(Markdown(text))
+
+    def extract_command(self, response: str, fenced_only: bool = False) -> Optional[str]:
         """Extract commands from the response."""
-        # First check for code blocks
-        if "```bash" in response or "```shell" in response:
-            # Find all code blocks
-            code_blocks = []
-            current_pos = 0
-            while True:
-                # Find the start of a code block
-                start = response.find("```bash", current_pos) if "```bash" in response[current_pos:] else response.find("```shell", current_pos)
-                if start == -1:
-                    break
-                
-                # Skip the ```bash or ```shell line
-                start = response.find('\n', start) + 1
-                # Find the end of the code block
-                end = response.find("```", start)
-                if end == -1:
-                    break
-                
-                # Extract the commands from the code block
-                command_block = response[start:end].strip()
-                # Get all non-empty lines that aren't comments
-                commands = []
-                for line in command_block.split('\n'):
-                    line = line.strip()
-                    if line and not line.strip().startswith('#'):
-                        # Remove prompt characters
-                        commands.append(line.lstrip('$> '))
-                
-                if commands:
-                    code_blocks.extend(commands)
-                
-                current_pos = end + 3
-            
-            if code_blocks:
-                # If we found multiple commands, join them with newlines
-                return '\n'.join(code_blocks)
+        # First check for code blocks, walking all ```bash/```shell fences in one pass
+        code_blocks = []
+        for match in _CODE_BLOCK_RE.finditer(response):
+            # Get all non-empty lines that aren't comments
+            for line in match.group(1).strip().split('\n'):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    # Remove prompt characters
+                    code_blocks.append(line.lstrip('$> '))
+        
+        if code_blocks:
+            # If we found multiple commands, join them with newlines
+            return '\n'.join(code_blocks)
+        if fenced_only:
+            return None
         
         # If no code block found, check for inline code blocks with backticks
-        inline_matches = re.findall(r'`([^`]+)`', response)
+        inline_matches = _INLINE_CODE_RE.findall(response) if "`" in response else None
         if inline_matches:
             # Return all command-like matches
             commands = []
             for match in inline_matches:
                 match = match.strip()
-                if any(match.startswith(cmd) for cmd in ['uname', 'ls', 'cd', 'sudo', 'apt', 'git', 'docker', 'python', 'pip']):
+                if match.startswith(_CMD_PREFIXES):
                     commands.append(match)
             if commands:
                 return '\n'.join(commands)
         
-        # If no inline code found, check for direct commands
-        lines = response.split('\n')
-        commands = []
-        for line in lines:
-            # Skip empty lines and comments
-            if not line.strip() or line.strip().startswith('#'):
-                continue
-                
-            # Skip explanatory text
-            if line.strip().startswith('To ') or line.strip().startswith('This '):
-                continue
-                
-            # Check if the line starts with a command pattern
-            if any(line.strip().startswith(pattern) for pattern in ['$', '>', 'sudo', 'docker', 'git', 'npm', 'python', 'pip', 'apt', 'yum', 'brew']):
-                # Remove prompt characters
-                commands.append(line.strip().lstrip('$> '))
+        # If no inline code found, check for lines that start like a command
+        commands = [line.lstrip('$> ') for line in _COMMAND_LINE_RE.findall(response)]
         
         if commands:
             return '\n'.join(commands)
@@ -272,16 +519,17 @@ This will list all files and directories in your home folder."""
 
     def convert_to_fish_syntax(self, command):
         """Convert bash commands to fish shell syntax"""
+        # Most commands have neither a loop nor a command substitution, so leave them untouched
+        if "for" not in command and "$(" not in command:
+            return command
         # Replace bash variable assignment
         command = command.replace("$(command)", "(command)")
         
         # Replace bash for loops with fish for loops
         if "for" in command and "do" in command and "done" in command:
             # Extract the loop variable and range
-            import re
-            
             # Handle nested loops first
-            nested_match = re.search(r'for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+(.*?)\s*done;\s*done', command)
+            nested_match = _NESTED_FOR_RE.search(command)
             if nested_match:
                 var1 = nested_match.group(1)
                 start1 = nested_match.group(2)
@@ -295,7 +543,7 @@ This will list all files and directories in your home folder."""
                 return f"for {var1} in (seq {start1} {end1})\nfor {var2} in (seq {start2} {end2})\n{loop_body}\nend\nend"
             
             # Handle {x..y} range syntax
-            range_match = re.search(r'for\s+(\w+)\s+in\s+\{(\d+)\.\.(\d+)\};\s*do\s+(.*?)\s*done', command)
+            range_match = _RANGE_FOR_RE.search(command)
             if range_match:
                 var_name = range_match.group(1)
                 start = range_match.group(2)
@@ -310,7 +558,7 @@ This will list all files and directories in your home folder."""
                 return f"for {var_name} in (seq {start} {end})\n{fish_body}\nend"
             
             # Handle $(seq x y) syntax
-            seq_match = re.search(r'for\s+(\w+)\s+in\s+\$\(seq\s+(\d+)\s+(\d+)\);\s*do\s+(.*?)\s*done', command)
+            seq_match = _SEQ_FOR_RE.search(command)
             if seq_match:
                 var_name = seq_match.group(1)
                 start = seq_match.group(2)
@@ -372,6 +620,7 @@ This will list all files and directories in your home folder."""
         self.console.print(f"\n[bold blue]Command to execute:[/bold blue] {command}")
         if Confirm.ask("[bold green]Execute this command?[/bold green]", default=default_yes):
             try:
+                self.console.print("[bold green]Output:[/bold green]")
                 # Use the appropriate shell based on the detected shell type
                 if self.shell_type == 'fish':
                     # For fish shell, convert bash syntax to fish syntax
@@ -379,29 +628,17 @@ This will list all files and directories in your home folder."""
                     self.console.print(f"[yellow]Converted to fish syntax:[/yellow] {fish_command}")
                     
                     # For fish shell, we need to use fish -c
-                    result = subprocess.run(
-                        ['fish', '-c', fish_command],
-                        capture_output=True,
-                        text=True
-                    )
+                    stdout, stderr = self.run_process(['fish', '-c', fish_command])
                 else:
                     # For other shells, use the shell directly
-                    result = subprocess.run(
-                        command,
-                        shell=True,
-                        capture_output=True,
-                        text=True
-                    )
+                    stdout, stderr = self.run_process(command, shell=True)
                 
+                # The output was already shown live, keep it for the model
                 output = []
-                if result.stdout:
-                    self.console.print("[bold green]Output:[/bold green]")
-                    self.console.print(result.stdout)
-                    output.append(result.stdout)
-                if result.stderr:
-                    self.console.print("[bold red]Error:[/bold red]")
-                    self.console.print(result.stderr)
-                    output.append(f"Error: {result.stderr}")
+                if stdout:
+                    output.append(stdout)
+                if stderr:
+                    output.append(f"Error: {stderr}")
                 return "\n".join(output) if output else None
             except Exception as e:
                 error_msg = f"[bold red]Error executing command: {str(e)}[/bold red]"
@@ -411,6 +648,69 @@ This will list all files and directories in your home folder."""
             self.console.print("[yellow]Command execution cancelled[/yellow]")
             return None
 
+    def run_process(self, args, shell=False):
+        """Run a command, showing its output as it arrives. Returns (stdout, stderr)"""
+        # A process group of its own lets a kill reach the whole pipeline and anything it started
+        process = subprocess.Popen(
+            args,
+            shell=shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",  # Binary output shouldn't stop the readers
+            process_group=0
+        )
+        terminal = _foreground_terminal()
+        if terminal is not None:
+            # Hand the command the terminal, so sudo and other tty prompts can read from it
+            try:
+                _set_foreground(terminal, process.pid)
+                os.killpg(process.pid, signal.SIGCONT)  # In case it read the terminal before getting it
+            except OSError:
+                terminal = None
+        stdout, stderr = BoundedOutput(), BoundedOutput()
+        # Held while a reader prints and stores a chunk, so once stop is set nothing more is written
+        output_lock = threading.Lock()
+        stop = threading.Event()
+        readers = [
+            threading.Thread(target=self._drain_stream, args=(process.stdout, stdout, None, output_lock, stop), daemon=True),
+            threading.Thread(target=self._drain_stream, args=(process.stderr, stderr, "red", output_lock, stop), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+        killed = False
+        try:
+            process.wait(timeout=COMMAND_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            killed = True
+            _kill_process_group(process)
+        except BaseException:
+            # Don't leave the command running when the chat is interrupted
+            killed = True
+            _kill_process_group(process)
+            raise
+        finally:
+            if terminal is not None:
+                _set_foreground(terminal, os.getpgrp())
+            for reader in readers:
+                # After a kill, only wait briefly for the output already written
+                reader.join(timeout=1 if killed else None)
+            # Anything that left the process group may still hold the pipes open, so stop the readers
+            with output_lock:
+                stop.set()
+        if killed:
+            stderr.write(f"Command timed out after {COMMAND_TIMEOUT} seconds\n")
+        return stdout.getvalue(), stderr.getvalue()
+
+    def _drain_stream(self, stream, output, style, output_lock, stop):
+        with stream:
+            for chunk in iter(lambda: stream.readline(OUTPUT_READ_SIZE), ''):
+                with output_lock:
+                    if stop.is_set():
+                        return
+                    self.console.print(chunk, end="", style=style, markup=False, highlight=False, soft_wrap=True)
+                    output.write(chunk)
+
     def show_help(self):
         help_text = """
         Available commands:
@@ -420,11 +720,29 @@ This will list all files and directories in your home folder."""
         """
         self.console.print(help_text)
 
+def parse_keep_alive(value):
+    """Ollama takes keep_alive as a duration like "30m" or as a number of seconds"""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
 def main():
-    agent = LocalAgent()
+    parser = argparse.ArgumentParser(description="Chat with a local Ollama model that can run commands on your system")
+    parser.add_argument("--model", default="llama3:latest", help="Ollama model to use (default: %(default)s)")
+    parser.add_argument("--test", action="store_true", help="Run the multiple command selection flow and exit")
+    parser.add_argument("--resume", action="store_true", help="Continue the previous chat session")
+    parser.add_argument("--offline", action="store_true", help="Skip checking that the model is available at startup")
+    parser.add_argument("--keep-alive", default="30m", type=parse_keep_alive,
+                        help="How long Ollama keeps the model loaded, e.g. 30m or -1 for forever (default: %(default)s)")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Show replies as they are generated (default: on)")
+    args = parser.parse_args()
+
+    agent = LocalAgent(model=args.model, keep_alive=args.keep_alive, offline=args.offline, stream=args.stream)
     
     # Add test mode
-    if len(sys.argv) > 1 and sys.argv[1] == "--test":
+    if args.test:
         agent.console.print("Running in test mode...")
         # Simulate multiple commands for testing
         test_commands = """
@@ -440,7 +758,7 @@ def main():
     agent.console.print(f"Model: {agent.model}")
     agent.console.print('Type \'exit\' to end the chat, \'help\' for commands\n')
     
-    agent.start_chat()
+    agent.start_chat(resume=args.resume)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
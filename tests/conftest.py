@@ -1,104 +1,169 @@
+"""Shared fixtures for the LocalAgent tests.
+
+Patches here and in the test modules use plain patch() without autospec: building a spec
+from the patched object roughly doubles the cost of each patch, and CI rejects any use of it.
+"""
 import pytest
-import sys
+import copy
+import io
 import os
-from unittest.mock import patch, MagicMock
+import orjson
+from collections import Counter, deque
+from types import SimpleNamespace
+from unittest.mock import patch, Mock, MagicMock, DEFAULT
 
-# Add the parent directory to the path so we can import the local_agent module
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from local_agent import LocalAgent
 
+def pytest_addoption(parser):
+    parser.addoption("--progress-file", metavar="PATH",
+                     help="Append a JSON line per finished test to PATH while the suite runs, "
+                          "and write a summary to PATH.summary.json at the end")
+
+# Where test results are logged as they finish, set by --progress-file
+_progress_path = None
+# Final outcome of each test, so a test reported in several phases is counted once
+_progress_outcomes = {}
+
+def pytest_configure(config):
+    global _progress_path
+    # Under xdist the controller receives every worker's reports, so only it writes
+    if not hasattr(config, "workerinput"):
+        _progress_path = config.getoption("--progress-file")
+
+def pytest_runtest_logreport(report):
+    # The call phase holds the outcome, except for tests skipped or failed in setup and teardown failures
+    if _progress_path is None or not (report.when == "call" or not report.passed):
+        return
+    if report.failed or report.nodeid not in _progress_outcomes:
+        _progress_outcomes[report.nodeid] = report.outcome
+    line = orjson.dumps({"nodeid": report.nodeid, "when": report.when,
+                         "outcome": report.outcome, "duration": report.duration})
+    # A single O_APPEND write keeps lines whole even if another run appends at the same time
+    fd = os.open(_progress_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line + b"\n")
+    finally:
+        os.close(fd)
+
+def pytest_sessionfinish(session, exitstatus):
+    if _progress_path is None:
+        return
+    summary = f"{_progress_path}.summary.json"
+    with open(f"{summary}.tmp", "wb") as f:
+        f.write(orjson.dumps({"exitstatus": int(exitstatus), **Counter(_progress_outcomes.values())}))
+    os.replace(f"{summary}.tmp", summary)
+
+@pytest.fixture(scope="session", autouse=True)
+def _plain_terminal():
+    """Make rich render without colors or animation, so Live needs no patching.
+
+    Commands are never handed the terminal either, even when running with -s from a shell.
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("TERM", "dumb")
+        mp.setenv("NO_COLOR", "1")
+        mp.setattr("local_agent._foreground_terminal", lambda: None)
+        yield
+
+@pytest.fixture(autouse=True)
+def isolated_state_file(tmp_path, monkeypatch):
+    """Keep the model cache and session log used by LocalAgent out of the user's home directory."""
+    state_file = tmp_path / "state.json"
+    monkeypatch.setattr('local_agent.STATE_FILE', state_file)
+    monkeypatch.setattr('local_agent.SESSION_FILE', tmp_path / "session.jsonl")
+    return state_file
+
+def configure_ollama_http(mock_get, mock_post):
+    """Report the model as available and accept every POST."""
+    # Mock the model check response
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
+    
+    # Mock the model pull response
+    mock_post.return_value.status_code = 200
+
+@pytest.fixture(scope="session", autouse=True)
+def _patch_ollama_http(request):
+    """Patch the HTTP calls to Ollama once for the whole session."""
+    patcher = patch.multiple('local_agent.requests.Session', get=DEFAULT, post=DEFAULT)
+    mocks = patcher.start()
+    request.addfinalizer(patcher.stop)
+    configure_ollama_http(mocks["get"], mocks["post"])
+    return SimpleNamespace(**mocks)
+
+@pytest.fixture(autouse=True)
+def _reset_ollama_http(_patch_ollama_http):
+    """Give every test freshly configured HTTP mocks without patching again."""
+    for mock in (_patch_ollama_http.get, _patch_ollama_http.post):
+        mock.reset_mock(return_value=True, side_effect=True)
+    configure_ollama_http(_patch_ollama_http.get, _patch_ollama_http.post)
+
+@pytest.fixture(scope="session")
+def agent_prototype(_patch_ollama_http, tmp_path_factory):
+    """Build one LocalAgent for the whole session; tests work on copies of it."""
+    state_dir = tmp_path_factory.mktemp("state")
+    with patch('local_agent.STATE_FILE', state_dir / "state.json"), \
+         patch('local_agent.SESSION_FILE', state_dir / "session.jsonl"):
+        return LocalAgent()
+
 @pytest.fixture
-def basic_agent():
-    """Basic fixture to create a LocalAgent instance for testing."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
-        
-        agent = LocalAgent()
-        return agent
+def agent_copy(agent_prototype):
+    """A copy of the session's LocalAgent with its own history, model check state and console."""
+    agent = copy.copy(agent_prototype)
+    # A mock console reads as Jupyter to rich's Live unless told otherwise
+    agent.console = MagicMock(is_jupyter=False)
+    agent.conversation_history = deque(maxlen=agent_prototype.conversation_history.maxlen)
+    agent._session_log = None
+    # start_chat warms the model up on a background thread, whose POST could land in the next test's mocks
+    agent.warm_up_model = Mock()
+    # Forget the prototype's startup model check, so status checks start from scratch
+    agent._tags_cache = None
+    agent._tags_checked_at = 0.0
+    return agent
 
 @pytest.fixture
-def agent_with_subprocess():
-    """Fixture to create a LocalAgent instance with subprocess mocking."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post, \
-         patch('local_agent.subprocess.run') as mock_run:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
-        
-        # Mock the subprocess run
-        mock_process = MagicMock()
-        mock_process.stdout = "Command output"
-        mock_process.stderr = ""
-        mock_run.return_value = mock_process
-        
-        agent = LocalAgent()
-        return agent
+def mock_ollama_http(_patch_ollama_http):
+    """The HTTP mocks for Ollama; the model is always reported as available."""
+    return _patch_ollama_http
 
 @pytest.fixture
-def agent_with_prompts():
-    """Fixture to create a LocalAgent instance with prompt mocking."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post, \
-         patch('local_agent.Prompt.ask') as mock_prompt, \
-         patch('local_agent.Confirm.ask') as mock_confirm:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
-        
-        # Mock the prompt to return '1' (first command)
-        mock_prompt.return_value = '1'
-        
-        # Mock the confirm to return True (yes)
-        mock_confirm.return_value = True
-        
-        agent = LocalAgent()
-        return agent
+def process_mock():
+    """Factory for mock Popen processes that produce the given output and exit with 0."""
+    def make_process(stdout="Command output", stderr=""):
+        # Only the streams and wait() are used, so skip the cost of a MagicMock
+        return SimpleNamespace(stdout=io.StringIO(stdout), stderr=io.StringIO(stderr), returncode=0,
+                               wait=Mock(return_value=0))
+    return make_process
 
 @pytest.fixture
-def full_agent():
-    """Complete fixture to create a LocalAgent instance with all mocking."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post, \
-         patch('local_agent.subprocess.run') as mock_run, \
-         patch('local_agent.Prompt.ask') as mock_prompt, \
-         patch('local_agent.Confirm.ask') as mock_confirm, \
-         patch('local_agent.Console.print') as mock_print, \
-         patch('local_agent.Live') as mock_live:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
+def mock_subprocess(process_mock):
+    """Patch Popen so every command prints "Command output" and succeeds."""
+    with patch('local_agent.subprocess.Popen') as mock_popen:
+        # A fresh process per call, since the agent reads each one's streams to the end
+        mock_popen.side_effect = lambda *args, **kwargs: process_mock()
         
-        # Mock the prompt to return 'exit'
+        yield SimpleNamespace(popen=mock_popen)
+
+@pytest.fixture
+def mock_prompts():
+    """Patch user prompts; prompts answer 'exit' and confirmations yes."""
+    with patch('local_agent.Prompt.ask') as mock_prompt, \
+         patch('local_agent.Confirm.ask') as mock_confirm:
         mock_prompt.return_value = 'exit'
-        
-        # Mock the confirm to return True (yes)
         mock_confirm.return_value = True
         
-        # Mock the subprocess run
-        mock_process = MagicMock()
-        mock_process.stdout = "Command output"
-        mock_process.stderr = ""
-        mock_run.return_value = mock_process
-        
-        # Mock the Live context manager
-        mock_live_context = MagicMock()
-        mock_live.return_value.__enter__.return_value = mock_live_context
-        
-        agent = LocalAgent()
-        return agent 
\ No newline at end of file
+        yield SimpleNamespace(prompt=mock_prompt, confirm=mock_confirm)
+
+# Mock fixtures enabled by each flag of the agent fixture
+_AGENT_MOCKS = {"subprocess": "mock_subprocess", "prompts": "mock_prompts"}
+
+@pytest.fixture
+def agent(request, agent_copy):
+    """A LocalAgent for testing; parametrize it indirectly to mock more of its dependencies, e.g.
+
+    @pytest.mark.parametrize("agent", [{"subprocess": True, "prompts": True}], indirect=True)
+    """
+    for flag, enabled in getattr(request, "param", {}).items():
+        if enabled:
+            request.getfixturevalue(_AGENT_MOCKS[flag])
+    return agent_copy
@@ -1,152 +1,209 @@
 import pytest
-import sys
-import os
-from unittest.mock import patch, MagicMock, Mock, call
+import signal
 import subprocess
-from rich.prompt import Prompt, Confirm
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch, call
 
-# Add the parent directory to the Python path
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_agent import BoundedOutput
 
-from local_agent import LocalAgent
+pytestmark = pytest.mark.command_exec
+
+@pytest.fixture
+def mocks(mock_subprocess, mock_prompts):
+    """The shared command execution and prompt mocks, set up for running commands."""
+    mock_prompts.prompt.return_value = 'c'  # Default to canceling in multiple command scenarios
+    return SimpleNamespace(popen=mock_subprocess.popen, confirm=mock_prompts.confirm, prompt=mock_prompts.prompt)
 
 @pytest.fixture
-def agent():
+def agent(agent_copy, mocks):
     """Create a LocalAgent instance with mocked components."""
-    with patch('subprocess.run') as mock_run, \
-         patch('rich.prompt.Confirm.ask') as mock_confirm, \
-         patch('rich.prompt.Prompt.ask') as mock_prompt:
-        agent = LocalAgent()
-        agent.console.print = MagicMock()
-        # Set up default mock responses
-        mock_confirm.return_value = True  # Default to confirming commands
-        mock_prompt.return_value = 'c'    # Default to canceling in multiple command scenarios
-        # Set up default subprocess response
-        mock_process = MagicMock()
-        mock_process.stdout = "Command output"
-        mock_process.stderr = ""
-        mock_run.return_value = mock_process
-        yield agent
-
-def test_execute_command_single_command(agent):
+    return agent_copy
+
+def test_execute_command_single_command(agent, mocks, process_mock):
     """Test executing a single command."""
     command = "uname -a"
     # Mock subprocess to return success
-    mock_process = MagicMock()
-    mock_process.stdout = "Linux test 5.15.0"
-    mock_process.stderr = ""
-    subprocess.run.return_value = mock_process
+    mocks.popen.side_effect = lambda *args, **kwargs: process_mock("Linux test 5.15.0")
     # Mock confirmation to return True
-    Confirm.ask.return_value = True
+    mocks.confirm.return_value = True
     
     output = agent.execute_command(command)
     
     assert output == "Linux test 5.15.0"
-    subprocess.run.assert_called_once()
-    Confirm.ask.assert_called_once()
+    mocks.popen.assert_called_once()
+    mocks.confirm.assert_called_once()
 
-def test_execute_command_multiple_commands(agent):
+def test_execute_command_multiple_commands(agent, mocks, process_mock):
     """Test executing multiple commands with selection."""
     commands = "uname -a\nlscpu\nfree -h"
     # Mock prompt to select first command
-    Prompt.ask.return_value = '1'
+    mocks.prompt.return_value = '1'
     # Mock subprocess to return success
-    mock_process = MagicMock()
-    mock_process.stdout = "Linux test 5.15.0"
-    mock_process.stderr = ""
-    subprocess.run.return_value = mock_process
+    mocks.popen.side_effect = lambda *args, **kwargs: process_mock("Linux test 5.15.0")
     
     output = agent.execute_command(commands)
     
     assert output == "Linux test 5.15.0"
-    subprocess.run.assert_called_once()
-    Prompt.ask.assert_called_once()
+    mocks.popen.assert_called_once()
+    mocks.prompt.assert_called_once()
 
-def test_execute_command_with_fish_shell(agent):
+def test_execute_command_with_fish_shell(agent, mocks, process_mock):
     """Test executing a command with fish shell."""
     # Mock the shell type to be fish
     agent.shell_type = 'fish'
     command = "for i in {1..5}; do echo $i; done"
     # Mock subprocess to return success
-    mock_process = MagicMock()
-    mock_process.stdout = "1\n2\n3\n4\n5\n"
-    mock_process.stderr = ""
-    subprocess.run.return_value = mock_process
+    mocks.popen.side_effect = lambda *args, **kwargs: process_mock("1\n2\n3\n4\n5\n")
     # Mock confirmation to return True
-    Confirm.ask.return_value = True
+    mocks.confirm.return_value = True
     
     output = agent.execute_command(command)
     
     assert output == "1\n2\n3\n4\n5\n"
-    subprocess.run.assert_called_once()
-    Confirm.ask.assert_called_once()
+    mocks.popen.assert_called_once()
+    mocks.confirm.assert_called_once()
 
-def test_execute_command_with_error(agent):
+def test_execute_command_with_error(agent, mocks, process_mock):
     """Test executing a command that returns an error."""
     command = "nonexistent_command"
     # Mock subprocess to return error
-    mock_process = MagicMock()
-    mock_process.stdout = ""
-    mock_process.stderr = "Error: Command not found"
-    subprocess.run.return_value = mock_process
+    mocks.popen.side_effect = lambda *args, **kwargs: process_mock("", "Error: Command not found")
     # Mock confirmation to return True
-    Confirm.ask.return_value = True
+    mocks.confirm.return_value = True
     
     output = agent.execute_command(command)
     
     assert "Error: Command not found" in output
-    subprocess.run.assert_called_once()
-    Confirm.ask.assert_called_once()
+    mocks.popen.assert_called_once()
+    mocks.confirm.assert_called_once()
+
+def test_execute_command_shows_output_live(agent, mocks, process_mock):
+    """Test that command output is printed as it is read."""
+    mocks.popen.side_effect = lambda *args, **kwargs: process_mock("line 1\nline 2\n", "warning\n")
+    
+    agent.execute_command("make")
+    
+    # stdout and stderr are read by separate threads, so only the order within each stream is fixed
+    printed = agent.console.print.call_args_list
+    stdout_calls = [c for c in printed if c.kwargs.get("style", "") is None]
+    assert stdout_calls == [
+        call("line 1\n", end="", style=None, markup=False, highlight=False, soft_wrap=True),
+        call("line 2\n", end="", style=None, markup=False, highlight=False, soft_wrap=True),
+    ]
+    assert call("warning\n", end="", style="red", markup=False, highlight=False, soft_wrap=True) in printed
 
-def test_execute_command_cancelled(agent):
+def test_execute_command_cancelled(agent, mocks):
     """Test cancelling command execution."""
     command = "uname -a"
     # Mock confirmation to return False
-    Confirm.ask.return_value = False
+    mocks.confirm.return_value = False
     
     output = agent.execute_command(command)
     
     assert output is None
-    subprocess.run.assert_not_called()
-    Confirm.ask.assert_called_once()
+    mocks.popen.assert_not_called()
+    mocks.confirm.assert_called_once()
 
-def test_execute_command_all_commands(agent):
+def test_execute_command_all_commands(agent, mocks, process_mock):
     """Test executing all commands when multiple are present."""
+    agent.shell_type = 'bash'
     commands = "uname -a\nlscpu\nfree -h"
     # Mock prompt to select 'a' for all commands
-    Prompt.ask.return_value = 'a'
+    mocks.prompt.return_value = 'a'
     # Mock subprocess to return success for each command
-    mock_process = MagicMock()
-    mock_process.stdout = "Command output"
-    mock_process.stderr = ""
-    subprocess.run.return_value = mock_process
+    mocks.popen.side_effect = lambda args, **kwargs: process_mock(f"{args} output")
     
     output = agent.execute_command(commands)
     
-    assert output == "Command output\nCommand output\nCommand output"
-    assert subprocess.run.call_count == 3
-    Prompt.ask.assert_called_once()
+    # Later commands may depend on earlier ones, so they run one at a time in the given order
+    assert output == "uname -a output\nlscpu output\nfree -h output"
+    assert [c.args[0] for c in mocks.popen.call_args_list] == ["uname -a", "lscpu", "free -h"]
+    mocks.prompt.assert_called_once()
 
-def test_execute_command_quit(agent):
+def test_execute_command_quit(agent, mocks):
     """Test quitting when multiple commands are present."""
     commands = "uname -a\nlscpu\nfree -h"
     # Mock prompt to select 'q' for quit
-    Prompt.ask.return_value = 'q'
+    mocks.prompt.return_value = 'q'
     
     with pytest.raises(SystemExit):
         agent.execute_command(commands)
     
-    subprocess.run.assert_not_called()
-    Prompt.ask.assert_called_once()
+    mocks.popen.assert_not_called()
+    mocks.prompt.assert_called_once()
 
-def test_execute_command_cancel_multiple(agent):
+def test_execute_command_cancel_multiple(agent, mocks):
     """Test cancelling when multiple commands are present."""
     commands = "uname -a\nlscpu\nfree -h"
     # Mock prompt to select 'c' for cancel
-    Prompt.ask.return_value = 'c'
+    mocks.prompt.return_value = 'c'
     
     output = agent.execute_command(commands)
     
     assert output is None
-    subprocess.run.assert_not_called()
-    Prompt.ask.assert_called_once() 
\ No newline at end of file
+    mocks.popen.assert_not_called()
+    mocks.prompt.assert_called_once()
+
+def test_run_process_timeout(agent, mocks, process_mock):
+    """Test that a command running past the timeout is killed along with its process group."""
+    process = process_mock("partial output")
+    process.pid = 1234
+    process.wait.side_effect = [subprocess.TimeoutExpired("sleep 1000", 120), 0]
+    mocks.popen.side_effect = None
+    mocks.popen.return_value = process
+    
+    with patch('local_agent.os.killpg') as mock_killpg:
+        stdout, stderr = agent.run_process("sleep 1000", shell=True)
+    
+    mock_killpg.assert_called_once_with(1234, signal.SIGKILL)
+    assert mocks.popen.call_args.kwargs['process_group'] == 0
+    assert stdout == "partial output"
+    assert "timed out" in stderr
+
+def test_run_process_interrupted(agent, mocks, process_mock):
+    """Test that interrupting a command kills it before the interrupt propagates."""
+    process = process_mock()
+    process.pid = 1234
+    process.wait.side_effect = [KeyboardInterrupt, 0]
+    mocks.popen.side_effect = None
+    mocks.popen.return_value = process
+    
+    with patch('local_agent.os.killpg') as mock_killpg, pytest.raises(KeyboardInterrupt):
+        agent.run_process("sleep 1000", shell=True)
+    
+    mock_killpg.assert_called_once_with(1234, signal.SIGKILL)
+    assert process.wait.call_count == 2
+
+def test_run_process_timeout_kills_pipeline(agent_copy, monkeypatch):
+    """Test that a timed-out pipeline is killed as a whole and its output stops."""
+    monkeypatch.setattr('local_agent.COMMAND_TIMEOUT', 0.3)
+    
+    stdout, stderr = agent_copy.run_process("while true; do echo tick; sleep 0.01; done | cat", shell=True)
+    printed = agent_copy.console.print.call_count
+    time.sleep(0.2)
+    
+    assert stdout.startswith("tick\n")
+    assert "timed out" in stderr
+    assert agent_copy.console.print.call_count == printed
+
+def test_run_process_undecodable_output(agent_copy):
+    """Test that output which isn't valid UTF-8 is replaced rather than lost."""
+    script = "import sys; sys.stdout.buffer.write(b'\\xff\\xfe ok\\n')"
+    stdout, stderr = agent_copy.run_process([sys.executable, "-c", script])
+    
+    assert stdout == "\ufffd\ufffd ok\n"
+    assert stderr == ""
+
+def test_bounded_output_keeps_head_and_tail():
+    """Test that long command output is truncated in the middle."""
+    output = BoundedOutput(head_size=10, tail_size=10)
+    for i in range(100):
+        output.write(f"line {i:02d}\n")
+    
+    text = output.getvalue()
+    assert text.startswith("line 00\nline 01\n")
+    assert text.endswith("line 99\n")
+    assert "characters truncated" in text
+    assert len(text) < 100
@@ -1,42 +1,22 @@
 import pytest
-import sys
-import os
-from unittest.mock import patch, MagicMock
 
-# Add the parent directory to the path so we can import the local_agent module
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from local_agent import LocalAgent
+pytestmark = pytest.mark.extract
 
-@pytest.fixture
-def agent():
-    """Fixture to create a LocalAgent instance for testing."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
-        
-        agent = LocalAgent()
-        return agent
+@pytest.fixture(scope="module")
+def agent(agent_prototype):
+    """extract_command doesn't change the agent, so the whole module shares one."""
+    return agent_prototype
 
-def test_extract_command_single_command(agent):
-    """Test extracting a single command from a response."""
-    response = """
+@pytest.mark.parametrize("response, expected", [
+    pytest.param("""
     To check your system information, I'll use the `uname` command:
     ```bash
     uname -a
     ```
     This will display detailed information about your system.
-    """
-    command = agent.extract_command(response)
-    assert command == "uname -a"
-
-def test_extract_command_multiple_commands(agent):
-    """Test extracting multiple commands from a response."""
-    response = """
+    """, "uname -a", id="single_command"),
+    # Should return all commands
+    pytest.param("""
     Here are some commands to check your system:
     
     ```bash
@@ -50,20 +30,9 @@ def test_extract_command_multiple_commands(agent):
     ```bash
     free -h
     ```
-    """
-    command = agent.extract_command(response)
-    # Should return all commands
-    assert command == "uname -a\nlscpu\nfree -h"
-
-def test_extract_command_no_commands(agent):
-    """Test extracting commands when none are present."""
-    response = "This is just some text without any commands."
-    command = agent.extract_command(response)
-    assert command is None
-
-def test_extract_command_with_explanatory_text(agent):
-    """Test extracting commands when there's explanatory text."""
-    response = """
+    """, "uname -a\nlscpu\nfree -h", id="multiple_commands"),
+    pytest.param("This is just some text without any commands.", None, id="no_commands"),
+    pytest.param("""
     To check your system information, I'll use the `uname` command.
     This will display detailed information about your system.
     
@@ -75,57 +44,62 @@ def test_extract_command_with_explanatory_text(agent):
     ```bash
     lscpu
     ```
-    """
-    command = agent.extract_command(response)
-    assert command == "uname -a\nlscpu"
-
-def test_extract_command_with_inline_code(agent):
-    """Test extracting commands from inline code blocks."""
-    response = """
+    """, "uname -a\nlscpu", id="with_explanatory_text"),
+    pytest.param("""
     You can use the `uname -a` command to check your system information.
     Or try `lscpu` for CPU details.
-    """
-    command = agent.extract_command(response)
-    assert command == "uname -a\nlscpu"
-
-def test_extract_command_with_comments(agent):
-    """Test extracting commands when there are comments in the code blocks."""
-    response = """
+    """, "uname -a\nlscpu", id="with_inline_code"),
+    pytest.param("""
     ```bash
     # This is a comment
     uname -a
     # Another comment
     ```
-    """
-    command = agent.extract_command(response)
-    assert command == "uname -a"
-
-def test_extract_command_with_prompt_characters(agent):
-    """Test extracting commands with prompt characters."""
-    response = """
+    """, "uname -a", id="with_comments"),
+    pytest.param("""
     ```bash
     $ uname -a
     ```
-    """
-    command = agent.extract_command(response)
-    assert command == "uname -a"
-
-def test_extract_command_with_sudo(agent):
-    """Test extracting commands with sudo."""
-    response = """
+    """, "uname -a", id="with_prompt_characters"),
+    pytest.param("""
     ```bash
     sudo apt update
     ```
-    """
-    command = agent.extract_command(response)
-    assert command == "sudo apt update"
-
-def test_extract_command_with_pipes(agent):
-    """Test extracting commands with pipes."""
-    response = """
+    """, "sudo apt update", id="with_sudo"),
+    pytest.param("""
     ```bash
     ps aux | grep python
     ```
+    """, "ps aux | grep python", id="with_pipes"),
+    # Shell and bash blocks are read in document order, other languages are skipped
+    pytest.param("""
+    ```shell
+    ls -la
+    ```
+    ```python
+    print('not a shell command')
+    ```
+    ```bash
+    pwd
+    ```
+    """, "ls -la\npwd", id="mixed_fences"),
+    # Lines outside code blocks that start like a command
+    pytest.param("""
+    To update your packages, run:
+    $ sudo apt update
+    # then upgrade
+    git status  
+    This should be all.
+    """, "sudo apt update\ngit status", id="bare_command_lines"),
+])
+def test_extract_command(agent, response, expected):
+    """Test extracting commands from a response."""
+    assert agent.extract_command(response) == expected
+
+def test_extract_command_fenced_only(agent):
+    """Test that inline code is ignored when only fenced commands are wanted."""
+    response = """
+    You can use the `uname -a` command to check your system information.
     """
-    command = agent.extract_command(response)
-    assert command == "ps aux | grep python"
\ No newline at end of file
+    assert agent.extract_command(response, fenced_only=True) is None
+    assert agent.extract_command("```bash\nuname -a\n```", fenced_only=True) == "uname -a"
@@ -1,47 +1,33 @@
 import pytest
-import sys
-import os
-from unittest.mock import patch, MagicMock, Mock
+from unittest.mock import patch, MagicMock, Mock, call
+import orjson
+import local_agent
+from local_agent import main
 
-# Add the parent directory to the path so we can import the local_agent module
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from local_agent import LocalAgent, main
+pytestmark = pytest.mark.chat_main
 
-@pytest.fixture
-def agent():
-    """Fixture to create a LocalAgent instance for testing."""
-    with patch('local_agent.requests.get') as mock_get, \
-         patch('local_agent.requests.post') as mock_post, \
-         patch('local_agent.subprocess.run') as mock_run, \
-         patch('local_agent.Prompt.ask') as mock_prompt, \
-         patch('local_agent.Confirm.ask') as mock_confirm, \
-         patch('local_agent.Console.print') as mock_print, \
-         patch('local_agent.Live') as mock_live:
-        # Mock the model check response
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"models": [{"name": "llama3:latest"}]}
-        
-        # Mock the model pull response
-        mock_post.return_value.status_code = 200
-        
-        # Mock the prompt to return 'exit'
-        mock_prompt.return_value = 'exit'
-        
-        # Mock the confirm to return True (yes)
-        mock_confirm.return_value = True
-        
-        # Mock the subprocess run
-        mock_process = MagicMock()
-        mock_process.stdout = "Command output"
-        mock_process.stderr = ""
-        mock_run.return_value = mock_process
-        
-        # Mock the Live context manager
-        mock_live_context = MagicMock()
-        mock_live.return_value.__enter__.return_value = mock_live_context
-        
-        agent = LocalAgent()
-        return agent
+# Feedback sent to the model after running `uname -a` with the default mocked output
+EXPECTED_FEEDBACK = "Command `uname -a` output:\nCommand output\nPlease analyze."
+HELP_TEXT = """
+        Available commands:
+        - help: Show this help message
+        - exit: End the chat session
+        - Any other input will be processed by the AI
+        """
+
+def test_detect_shell(agent, monkeypatch):
+    """Test detecting the shell from the $SHELL executable name."""
+    monkeypatch.setenv('SHELL', '/usr/bin/fish')
+    assert agent.detect_shell() == 'fish'
+    monkeypatch.setenv('SHELL', '/bin/zsh')
+    assert agent.detect_shell() == 'zsh'
+
+def test_detect_shell_ignores_directory_names(agent, monkeypatch):
+    """Test that a shell name in a parent directory doesn't affect detection."""
+    monkeypatch.setenv('SHELL', '/opt/bash-tools/bin/sh')
+    assert agent.detect_shell() == 'sh'
+    monkeypatch.delenv('SHELL')
+    assert agent.detect_shell() == 'sh'
 
 def test_start_chat_ollama_not_running(agent):
     """Test starting chat when Ollama is not running."""
@@ -56,6 +42,18 @@ def test_start_chat_ollama_not_running(agent):
     # Check that the error was logged
     agent.console.print.assert_called_with("[red]Error: Ollama is not running. Please start it using 'docker-compose up -d'[/red]")
 
+@pytest.mark.parametrize("agent", [{"prompts": True}], indirect=True)
+def test_start_chat_warms_up_model(agent):
+    """Test that starting a chat loads the model on a background thread."""
+    agent.check_ollama_status = MagicMock(return_value=True)
+    
+    with patch('local_agent.threading.Thread') as mock_thread:
+        agent.start_chat()
+    
+    mock_thread.assert_called_once_with(target=agent.warm_up_model, daemon=True)
+    mock_thread.return_value.start.assert_called_once()
+
+@pytest.mark.parametrize("agent", [{"prompts": True}], indirect=True)
 def test_start_chat_exit_command(agent):
     """Test starting chat and exiting immediately."""
     # Mock check_ollama_status to return True
@@ -70,15 +68,16 @@ def test_start_chat_exit_command(agent):
     # Mock console.print
     agent.console.print = MagicMock()
     
-    # Mock Prompt.ask to return 'exit'
-    with patch('rich.prompt.Prompt.ask', return_value='exit'):
-        agent.start_chat()
+    # The mocked Prompt.ask returns 'exit'
+    agent.start_chat()
     
     # Check that the welcome message was printed
-    agent.console.print.assert_any_call("[green]Starting chat with Local Agent...[/green]")
-    agent.console.print.assert_any_call(f"[yellow]Using {agent.shell_type} shell[/yellow]")
-    agent.console.print.assert_any_call("[yellow]Model: llama3:latest[/yellow]")
-    agent.console.print.assert_any_call("[yellow]Type 'exit' to end the chat, 'help' for commands[/yellow]")
+    assert agent.console.print.call_args_list[:4] == [
+        call("[green]Starting chat with Local Agent...[/green]"),
+        call(f"[yellow]Using {agent.shell_type} shell[/yellow]"),
+        call("[yellow]Model: llama3:latest[/yellow]"),
+        call("[yellow]Type 'exit' to end the chat, 'help' for commands[/yellow]"),
+    ]
 
 def test_start_chat_help_command(agent):
     """Test starting chat and using the help command."""
@@ -93,13 +92,18 @@ def test_start_chat_help_command(agent):
         agent.start_chat()
     
     # Check that the help message was printed
-    help_text = """
-        Available commands:
-        - help: Show this help message
-        - exit: End the chat session
-        - Any other input will be processed by the AI
-        """
-    agent.console.print.assert_any_call(help_text)
+    agent.console.print.assert_any_call(HELP_TEXT)
+
+def test_start_chat_quit_command(agent):
+    """Test that quit variants end the chat without asking the model."""
+    agent.check_ollama_status = MagicMock(return_value=True)
+    agent.get_ollama_response = MagicMock()
+    agent.console.print = MagicMock()
+    
+    with patch('rich.prompt.Prompt.ask', side_effect=['QUIT']):
+        agent.start_chat()
+    
+    agent.get_ollama_response.assert_not_called()
 
 def test_start_chat_with_command_execution(agent):
     """Test starting chat and executing a command."""
@@ -154,6 +158,84 @@ def test_main_function(agent):
         # Check that start_chat was called
         agent.start_chat.assert_called_once()
 
+def test_main_function_model_flag(agent):
+    """Test that the --model flag is passed to the agent."""
+    with patch('local_agent.LocalAgent', return_value=agent) as mock_agent_class:
+        agent.start_chat = MagicMock()
+        
+        with patch('sys.argv', ['local_agent.py', '--model', 'mistral:latest']):
+            main()
+        
+        mock_agent_class.assert_called_once_with(model='mistral:latest', keep_alive='30m', offline=False, stream=True)
+
+def test_main_function_offline_flag(agent):
+    """Test that the --offline flag is passed to the agent."""
+    with patch('local_agent.LocalAgent', return_value=agent) as mock_agent_class:
+        agent.start_chat = MagicMock()
+        
+        with patch('sys.argv', ['local_agent.py', '--offline']):
+            main()
+        
+        mock_agent_class.assert_called_once_with(model='llama3:latest', keep_alive='30m', offline=True, stream=True)
+
+def test_main_function_keep_alive_and_stream_flags(agent):
+    """Test that --keep-alive and --no-stream are passed to the agent."""
+    with patch('local_agent.LocalAgent', return_value=agent) as mock_agent_class:
+        agent.start_chat = MagicMock()
+        
+        with patch('sys.argv', ['local_agent.py', '--keep-alive=-1', '--no-stream']):
+            main()
+        
+        mock_agent_class.assert_called_once_with(model='llama3:latest', keep_alive=-1, offline=False, stream=False)
+
+def test_main_function_resume_flag(agent):
+    """Test that the --resume flag is passed to start_chat."""
+    with patch('local_agent.LocalAgent', return_value=agent):
+        agent.start_chat = MagicMock()
+        
+        with patch('sys.argv', ['local_agent.py', '--resume']):
+            main()
+        
+        agent.start_chat.assert_called_once_with(resume=True)
+
+def test_start_chat_resume_session(agent):
+    """Test that a resumed chat restores and extends the previous session log."""
+    agent.open_session_log()
+    agent.add_message("user", "first question")
+    agent.add_message("assistant", "first answer")
+    agent._session_log.close()
+    agent.conversation_history.clear()
+    
+    agent.check_ollama_status = MagicMock(return_value=True)
+    agent.get_ollama_response = MagicMock(return_value="second answer")
+    agent.process_response = MagicMock()
+    
+    with patch('rich.prompt.Prompt.ask', side_effect=['second question', 'exit']):
+        agent.start_chat(resume=True)
+    agent._session_log.close()
+    
+    expected = [
+        {"role": "user", "content": "first question"},
+        {"role": "assistant", "content": "first answer"},
+        {"role": "assistant", "content": "second answer"}
+    ]
+    assert list(agent.conversation_history) == expected
+    with open(local_agent.SESSION_FILE, "rb") as f:
+        assert [orjson.loads(line) for line in f] == expected
+
+def test_open_session_log_keeps_previous_sessions(agent):
+    """Test that starting a chat without --resume appends to the session log."""
+    agent.open_session_log()
+    agent.add_message("user", "first question")
+    agent._session_log.close()
+    
+    agent.open_session_log()
+    agent.add_message("user", "second question")
+    agent._session_log.close()
+    
+    with open(local_agent.SESSION_FILE, "rb") as f:
+        assert [orjson.loads(line)["content"] for line in f] == ["first question", "second question"]
+
 def test_main_function_test_mode(monkeypatch):
     """Test the main function in test mode"""
     # Create a mock agent
@@ -199,8 +281,8 @@ def test_process_response_with_command(agent):
     """Test processing a response with a command."""
     response = "```bash\nuname -a\n```"
     
-    # Mock extract_command to return a command
-    agent.extract_command = MagicMock(return_value="uname -a")
+    # Mock extract_command to return a command, and none in the follow-up analysis
+    agent.extract_command = MagicMock(side_effect=["uname -a", None])
     
     # Mock execute_command to return output
     agent.execute_command = MagicMock(return_value="Command output")
@@ -213,17 +295,42 @@ def test_process_response_with_command(agent):
     
     agent.process_response(response)
     
-    # Check that extract_command was called with the response
-    agent.extract_command.assert_called_once_with(response)
+    # Check that extract_command was called with the response, then with the analysis
+    agent.extract_command.assert_any_call(response, fenced_only=True)
+    agent.extract_command.assert_called_with("Analysis of the output", fenced_only=True)
     
     # Check that execute_command was called with the command
     agent.execute_command.assert_called_once_with("uname -a")
     
     # Check that get_ollama_response was called with the feedback
-    agent.get_ollama_response.assert_called_once_with("I executed the command 'uname -a' and got this output:\nCommand output\nPlease analyze this output and let me know if you need any clarification or if there's anything important I should know.")
+    agent.get_ollama_response.assert_called_once_with(EXPECTED_FEEDBACK)
+    
+    # Check that the analysis was added to the conversation
+    assert agent.conversation_history[-1] == {"role": "assistant", "content": "Analysis of the output"}
+
+def test_process_response_stops_after_max_rounds(agent):
+    """Test that a model that keeps asking for commands is eventually stopped."""
+    agent.extract_command = MagicMock(return_value="uname -a")
+    agent.execute_command = MagicMock(return_value="Command output")
+    agent.get_ollama_response = MagicMock(return_value="```bash\nuname -a\n```")
+    agent.console.print = MagicMock()
+    
+    agent.process_response("```bash\nuname -a\n```")
+    
+    assert agent.execute_command.call_count == local_agent.MAX_COMMAND_ROUNDS
+    agent.console.print.assert_called_with(f"[yellow]Stopped after {local_agent.MAX_COMMAND_ROUNDS} commands in a row[/yellow]")
+
+def test_process_response_last_round_without_command(agent):
+    """Test that no limit warning is shown when the reply to the last command asks for no more."""
+    agent.extract_command = MagicMock(side_effect=["uname -a"] * local_agent.MAX_COMMAND_ROUNDS + [None])
+    agent.execute_command = MagicMock(return_value="Command output")
+    agent.get_ollama_response = MagicMock(return_value="Looks good")
+    agent.console.print = MagicMock()
+    
+    agent.process_response("```bash\nuname -a\n```")
     
-    # Check that the analysis was printed
-    agent.console.print.assert_any_call("\n[green]Assistant:[/green] Analysis of the output")
+    assert agent.execute_command.call_count == local_agent.MAX_COMMAND_ROUNDS
+    agent.console.print.assert_not_called()
 
 def test_process_response_without_command(agent):
     """Test processing a response without a command."""
@@ -245,7 +352,7 @@ def test_process_response_without_command(agent):
     agent.process_response(response)
     
     # Check that extract_command was called with the response
-    mock_extract.assert_called_once_with(response)
+    mock_extract.assert_called_once_with(response, fenced_only=True)
     
     # Check that execute_command was not called
     mock_execute.assert_not_called()
@@ -1,116 +1,246 @@
 import pytest
-import sys
-import os
-from unittest.mock import patch, MagicMock, Mock, call
+from unittest.mock import Mock
 import requests
+import orjson
+from types import SimpleNamespace
 
-# Add the parent directory to the Python path
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_agent import LocalAgent, OLLAMA_URL, TAGS_URL, CHAT_URL
 
-from local_agent import LocalAgent
+pytestmark = [pytest.mark.unit, pytest.mark.fast, pytest.mark.timeout(2)]
 
-@pytest.fixture
-def agent():
-    """Create a LocalAgent instance with mocked HTTP requests."""
-    with patch('requests.get') as mock_get, \
-         patch('requests.post') as mock_post:
-        agent = LocalAgent()
-        agent.console.print = MagicMock()
-        yield agent
+# Raised by the mocked HTTP calls to simulate Ollama being unreachable
+_CONN_ERR = requests.exceptions.ConnectionError()
 
-def test_check_ollama_status_running(agent):
-    """Test checking Ollama status when it's running."""
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    requests.get.return_value = mock_response
+def make_response(status_code=200, lines=(), content=b"", json=None):
+    """Create a stand-in for a requests.Response with just the parts LocalAgent reads."""
+    return SimpleNamespace(status_code=status_code, iter_lines=lambda: iter(lines), content=content,
+                           json=lambda: json, close=lambda: None)
+
+@pytest.fixture(scope="module")
+def shared_agent(agent_prototype):
+    """An agent shared by the tests in this module that don't change it."""
+    return agent_prototype
+
+@pytest.mark.parametrize("connect_error, expected", [
+    pytest.param(None, True, id="running"),
+    pytest.param(ConnectionRefusedError(), False, id="not_running"),
+])
+def test_check_ollama_status(agent, mocker, connect_error, expected):
+    """Test checking Ollama status with a TCP probe."""
+    mock_connect = mocker.patch('local_agent.socket.create_connection', side_effect=connect_error)
+    
+    assert agent.check_ollama_status() is expected
+    
+    mock_connect.assert_called_once_with(('localhost', 11434), timeout=0.25)
+    requests.Session.get.assert_not_called()
+
+def test_check_ollama_status_after_model_check(agent, mocker):
+    """Test that a fresh model list from ensure_model skips the status probe."""
+    requests.Session.get.return_value = make_response(json={'models': [{'name': 'llama3:latest'}]})
+    agent.ensure_model()
+    
+    mock_connect = mocker.patch('local_agent.socket.create_connection')
     
     assert agent.check_ollama_status() is True
-    assert requests.get.call_count >= 1
-    assert requests.get.call_args_list[-1] == call('http://localhost:11434/api/tags')
+    
+    mock_connect.assert_not_called()
 
-def test_check_ollama_status_not_running(agent):
-    """Test checking Ollama status when it's not running."""
-    requests.get.side_effect = requests.exceptions.ConnectionError()
+def test_offline_skips_model_check(mock_ollama_http):
+    """Test that an offline agent doesn't contact Ollama at startup."""
+    LocalAgent(offline=True)
     
-    assert agent.check_ollama_status() is False
-    assert requests.get.call_count >= 1
-    assert requests.get.call_args_list[-1] == call('http://localhost:11434/api/tags')
+    mock_ollama_http.get.assert_not_called()
 
 def test_get_ollama_response_success(agent):
     """Test getting a successful response from Ollama."""
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.json.return_value = {'response': 'Test response'}
-    requests.post.return_value = mock_response
+    requests.Session.post.return_value = make_response(lines=[
+        '{"message": {"role": "assistant", "content": "Test "}, "done": false}',
+        '',
+        '{"message": {"role": "assistant", "content": "response"}, "done": true}'
+    ])
     
     response = agent.get_ollama_response('Test prompt')
     assert response == 'Test response'
-    requests.post.assert_called_once()
+    requests.Session.post.assert_called_once()
+    assert requests.Session.post.call_args.kwargs['stream'] is True
+    assert requests.Session.post.call_args.args[0] == CHAT_URL
+    payload = orjson.loads(requests.Session.post.call_args.kwargs['data'])
+    assert payload['messages'][-1] == {'role': 'user', 'content': 'Test prompt'}
+    assert payload['keep_alive'] == '30m'
+    assert payload['model'] == 'llama3:latest'
+    assert payload['stream'] is True
+
+def test_get_ollama_response_reads_stream_to_end(agent):
+    """Test that the stream is read past the done chunk so the connection can be reused."""
+    lines = iter(['{"message": {"content": "ok"}, "done": true}', ''])
+    requests.Session.post.return_value = make_response(lines=lines)
+    
+    assert agent.get_ollama_response('Test prompt') == 'ok'
+    assert next(lines, None) is None
+
+def test_get_ollama_response_follows_model_change(agent):
+    """Test that chat requests use the model set after the agent was created."""
+    requests.Session.post.return_value = make_response(lines=['{"message": {"content": "ok"}, "done": true}'])
+    agent.model = 'mistral:latest'
+    
+    agent.get_ollama_response('Test prompt')
+    
+    payload = orjson.loads(requests.Session.post.call_args.kwargs['data'])
+    assert payload['model'] == 'mistral:latest'
 
-def test_get_ollama_response_error(agent):
-    """Test handling an error response from Ollama."""
-    mock_response = MagicMock()
-    mock_response.status_code = 500
-    requests.post.return_value = mock_response
+def test_get_ollama_response_custom_keep_alive(agent):
+    """Test that a configured keep_alive is sent with chat requests."""
+    requests.Session.post.return_value = make_response(lines=['{"message": {"content": "ok"}, "done": true}'])
+    agent.keep_alive = -1
+    
+    agent.get_ollama_response('Test prompt')
+    
+    payload = orjson.loads(requests.Session.post.call_args.kwargs['data'])
+    assert payload['keep_alive'] == -1
+
+def test_get_ollama_response_no_stream(agent):
+    """Test that a non-streaming agent reads the complete reply from the response body."""
+    mock_response = make_response(content=b'{"message": {"role": "assistant", "content": "Test response"}, "done": true}')
+    mock_response.iter_lines = Mock()
+    requests.Session.post.return_value = mock_response
+    agent.stream = False
+    
+    response = agent.get_ollama_response('Test prompt')
+    
+    assert response == 'Test response'
+    assert requests.Session.post.call_args.kwargs['stream'] is False
+    payload = orjson.loads(requests.Session.post.call_args.kwargs['data'])
+    assert payload['stream'] is False
+    mock_response.iter_lines.assert_not_called()
+
+def test_warm_up_model(agent):
+    """Test that warming up loads the model without sending any messages."""
+    del agent.warm_up_model  # Use the real method instead of the fixture's stub
+    agent.warm_up_model()
+    
+    assert requests.Session.post.call_args.args[0] == CHAT_URL
+    payload = orjson.loads(requests.Session.post.call_args.kwargs['data'])
+    assert payload == {'model': 'llama3:latest', 'messages': [], 'keep_alive': '30m'}
+
+def test_get_ollama_response_stream_error(agent):
+    """Test handling an error reported in the middle of a streamed response."""
+    requests.Session.post.return_value = make_response(lines=[
+        '{"message": {"role": "assistant", "content": "Test"}, "done": false}',
+        '{"error": "model crashed"}'
+    ])
     
     response = agent.get_ollama_response('Test prompt')
     assert response is None
-    requests.post.assert_called_once()
+    agent.console.print.assert_any_call("[red]Error getting response from Ollama: model crashed[/red]")
 
-def test_get_ollama_response_connection_error(agent):
-    """Test handling a connection error from Ollama."""
-    requests.post.side_effect = requests.exceptions.ConnectionError()
+@pytest.mark.parametrize("status_code, error", [
+    pytest.param(500, None, id="error"),
+    pytest.param(None, _CONN_ERR, id="connection_error"),
+])
+def test_get_ollama_response_failure(agent, status_code, error):
+    """Test handling an error response or a connection error from Ollama."""
+    requests.Session.post.return_value = make_response(status_code)
+    requests.Session.post.side_effect = error
     
     response = agent.get_ollama_response('Test prompt')
     assert response is None
-    requests.post.assert_called_once()
+    requests.Session.post.assert_called_once()
 
-def test_pull_model_success(agent):
-    """Test successfully pulling a model."""
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.json.return_value = {'status': 'success'}
-    requests.post.return_value = mock_response
+@pytest.mark.parametrize("status_code, error, expected", [
+    pytest.param(200, None, True, id="success"),
+    pytest.param(500, None, False, id="error"),
+    pytest.param(None, _CONN_ERR, False, id="connection_error"),
+])
+def test_pull_model(agent, status_code, error, expected):
+    """Test pulling a model, including error responses and connection errors."""
+    requests.Session.post.return_value = make_response(status_code, json={'status': 'success'})
+    requests.Session.post.side_effect = error
     
-    assert agent.pull_model() is True
-    requests.post.assert_called_once()
+    assert agent.pull_model() is expected
+    requests.Session.post.assert_called_once()
 
-def test_pull_model_error(agent):
-    """Test handling an error when pulling a model."""
-    mock_response = MagicMock()
-    mock_response.status_code = 500
-    requests.post.return_value = mock_response
+def test_ensure_model_caches_model_list(agent, isolated_state_file):
+    """Test that the model list fetched from Ollama is cached for later runs."""
+    requests.Session.get.return_value = make_response(json={'models': [{'name': 'llama3:latest'}]})
     
-    assert agent.pull_model() is False
-    requests.post.assert_called_once()
+    agent.ensure_model()
+    
+    assert agent.load_cached_models() == ['llama3:latest']
+    assert isolated_state_file.exists()
 
-def test_pull_model_connection_error(agent):
-    """Test handling a connection error when pulling a model."""
-    requests.post.side_effect = requests.exceptions.ConnectionError()
+def test_save_cached_models_uses_own_temp_file(agent, isolated_state_file, mocker):
+    """Test that each save writes a temp file of its own and leaves none behind on failure."""
+    agent.save_cached_models(['llama3:latest'])
+    mocker.patch('local_agent.os.replace', side_effect=OSError)
+    agent.save_cached_models(['mistral:latest'])
     
-    assert agent.pull_model() is False
-    requests.post.assert_called_once()
+    assert [path.name for path in isolated_state_file.parent.glob("state*")] == ['state.json']
+    assert agent.load_cached_models() == ['llama3:latest']
 
-def test_extract_command_with_command():
-    """Test extracting a command from a response that contains one."""
-    agent = LocalAgent()
-    response = "Here's a command:\n```bash\nls -la\n```"
+def test_ensure_model_uses_cached_model_list(agent):
+    """Test that a fresh cache entry skips the request to Ollama."""
+    agent.save_cached_models(['llama3:latest'])
+    requests.Session.get.reset_mock()
+    
+    agent.ensure_model()
     
-    command = agent.extract_command(response)
-    assert command == "ls -la"
+    requests.Session.get.assert_not_called()
 
-def test_extract_command_without_command():
-    """Test extracting a command from a response that doesn't contain one."""
-    agent = LocalAgent()
-    response = "This is just a regular response without a command."
+def test_ensure_model_ignores_stale_cache(agent, mocker):
+    """Test that an expired cache entry falls back to asking Ollama."""
+    mock_time = mocker.patch('local_agent.time.time', return_value=0)
+    agent.save_cached_models(['llama3:latest'])
+    mocker.stop(mock_time)
+    requests.Session.get.reset_mock()
     
-    command = agent.extract_command(response)
-    assert command is None
+    agent.ensure_model()
+    
+    assert requests.Session.get.call_count == 1
+    assert requests.Session.get.call_args.args == (TAGS_URL,)
+
+@pytest.mark.parametrize("response, expected", [
+    pytest.param("Here's a command:\n```bash\nls -la\n```", "ls -la", id="with_command"),
+    pytest.param("This is just a regular response without a command.", None, id="without_command"),
+    # Should return all commands found
+    pytest.param("Here are some commands:\n```bash\nls -la\n```\n```bash\necho 'test'\n```",
+                 "ls -la\necho 'test'", id="with_multiple_commands"),
+])
+def test_extract_command(shared_agent, response, expected):
+    """Test extracting commands from a model response."""
+    assert shared_agent.extract_command(response) == expected
 
-def test_extract_command_with_multiple_commands():
-    """Test extracting a command when multiple commands are present."""
-    agent = LocalAgent()
-    response = "Here are some commands:\n```bash\nls -la\n```\n```bash\necho 'test'\n```"
+def test_session_reuses_pooled_connections(agent):
+    """Test that the agent talks to Ollama through a pooled keep-alive session."""
+    adapter = agent.session.get_adapter(OLLAMA_URL)
+    assert adapter._pool_maxsize == 10
+    assert agent.session.headers['Connection'] == 'keep-alive'
+
+def test_get_ollama_response_context_window(agent):
+    """Test that the context window grows append-only and is trimmed in half-window steps."""
+    requests.Session.post.return_value = make_response(lines=['{"message": {"content": "ok"}, "done": true}'])
+    history = [{"role": "user", "content": str(i)} for i in range(19)]
+    agent.conversation_history.extend(history)
+    
+    agent.get_ollama_response('first')
+    messages = orjson.loads(requests.Session.post.call_args.kwargs['data'])['messages']
+    assert messages[0] == {'role': 'system', 'content': agent.system_prompt}
+    assert messages[1:] == list(agent.conversation_history)
+    assert len(agent.conversation_history) == 20
+    
+    agent.get_ollama_response('second')
+    messages = orjson.loads(requests.Session.post.call_args.kwargs['data'])['messages']
+    assert messages[0] == {'role': 'system', 'content': agent.system_prompt}
+    assert messages[1:-1] == history[10:] + [{'role': 'user', 'content': 'first'}]
+    assert len(agent.conversation_history) == 11
+
+def test_close_releases_session(agent):
+    """Test that closing the agent closes its HTTP session and session log."""
+    agent.open_session_log()
+    agent.session = Mock()
+    session_log = agent._session_log
+    
+    agent.close()
     
-    command = agent.extract_command(response)
-    assert command == "ls -la\necho 'test'"  # Should return all commands found 
\ No newline at end of file
+    agent.session.close.assert_called_once()
+    assert session_log.closed
+    assert agent._session_log is None